@@ -17,11 +17,24 @@ import time
 import json
 import argparse
 from typing import Tuple, List, Dict, Any, Optional
+from urllib.parse import urlparse, parse_qs
 import csv
+import glob
 import shutil
-import re
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# orjson parses/serializes in C (and writes UTF-8 bytes directly); fall back to stdlib json when absent.
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 # Auto-load environment variables from a local .env file when python-dotenv is installed.
 try:
@@ -39,17 +52,97 @@ IP_GEO_SERVICES = [
 	"https://ipinfo.io/json",
 ]
 
+USER_AGENT = "GCP-Places-API-Vet-Scraper/1.0"
+# Connections kept alive per host; concurrency beyond this uses throwaway connections.
+POOL_MAXSIZE = 32
+
+
+def build_session() -> requests.Session:
+	"""Create a requests Session with keep-alive connection pooling and retries.
+
+	Reusing one Session across all calls avoids a fresh TCP+TLS handshake per request.
+	Compression is requested explicitly; urllib3's ACCEPT_ENCODING only lists codecs it can
+	decode (br/zstd when brotli/zstandard are installed), so responses are always decompressed.
+	"""
+	session = requests.Session()
+	retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+	adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=retry, pool_block=False)
+	session.mount("https://", adapter)
+	session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING})
+	return session
+
+
+# Shared Session used by all HTTP calls; tests may pass their own via the `session` argument.
+SESSION = build_session()
+
+
+def parse_response(resp: requests.Response) -> Any:
+	"""Decode a JSON response body, using orjson when available."""
+	if orjson is not None:
+		return orjson.loads(resp.content)
+	return resp.json()
+
+
+class TokenBucket:
+	"""Thread-safe token-bucket rate limiter.
+
+	Tokens refill continuously at `rate_per_sec` up to `capacity`; acquire() blocks until a
+	token is available. Lets the worker pools run near the Places API quota without
+	tripping OVER_QUERY_LIMIT.
+	"""
+
+	def __init__(self, rate_per_sec: float = 50.0, capacity: Optional[float] = None):
+		self.rate = float(rate_per_sec)
+		# At least one token of capacity, otherwise rates below 1/s could never grant a request
+		self.capacity = max(1.0, float(capacity if capacity is not None else rate_per_sec))
+		self._tokens = self.capacity
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self) -> None:
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+				self._last = now
+				if self._tokens >= 1.0:
+					self._tokens -= 1.0
+					return
+				wait = (1.0 - self._tokens) / self.rate
+			# Sleep outside the lock so other threads can refill/check meanwhile
+			time.sleep(wait)
+
+
+# Default Places API request rate (requests/second); override with --qps.
+DEFAULT_QPS = 50.0
+
+# Shared limiter applied to every Places API request; main() replaces it according to --qps.
+RATE_LIMITER = TokenBucket(DEFAULT_QPS)
+
+
+def places_get(session: requests.Session, url: str, params: Dict[str, Any]) -> requests.Response:
+	"""GET a Places API endpoint through the shared rate limiter."""
+	RATE_LIMITER.acquire()
+	return session.get(url, params=params, timeout=10)
 
-def get_ip_location() -> Optional[Tuple[float, float]]:
+
+# Default number of concurrent API requests per phase (keep well under the per-project QPS quota).
+# Capped at POOL_MAXSIZE: the adapter doesn't block (pool_block=False), so workers beyond the pool
+# size would open extra connections that are discarded after use instead of kept alive.
+DEFAULT_WORKERS = 16
+
+
+def get_ip_location(session: Optional[requests.Session] = None) -> Optional[Tuple[float, float]]:
 	"""Attempt to get approximate lat/lon for the current machine's public IP.
 
 	Returns (lat, lon) or None if lookup fails.
 	"""
+	session = session or SESSION
 	for url in IP_GEO_SERVICES:
 		try:
-			r = requests.get(url, timeout=5)
+			r = session.get(url, timeout=5)
 			r.raise_for_status()
-			data = r.json()
+			data = parse_response(r)
 			# ipapi.co returns 'latitude' and 'longitude'
 			if "latitude" in data and "longitude" in data:
 				return float(data["latitude"]), float(data["longitude"])
@@ -63,35 +156,138 @@ def get_ip_location() -> Optional[Tuple[float, float]]:
 	return None
 
 
-def nearby_search(lat: float, lng: float, radius: int, api_key: str, queries: List[Dict[str, Optional[str]]]) -> List[Dict[str, Any]]:
-	"""Perform multiple Nearby Search queries (type/keyword combos) and return deduplicated result items.
+NEARBY_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+FIND_PLACE_URL = "https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
+
+# Statuses meaning the key's quota is exhausted: every further call would fail too.
+QUOTA_STATUSES = ("OVER_QUERY_LIMIT", "OVER_DAILY_LIMIT")
+
+
+class QuotaExceededError(Exception):
+	"""Raised when the Places API reports the key is over its query quota."""
+
+
+def _check_quota(data: Dict[str, Any]) -> None:
+	status = data.get("status")
+	if status in QUOTA_STATUSES:
+		raise QuotaExceededError(f"{status}: {data.get('error_message', 'quota exceeded')}")
 
-	`queries` should be a list of dicts with either 'type' or 'keyword' (or both). Example:
-	  [{'type': 'veterinary_care'}, {'keyword': 'veterinary'}, {'keyword': 'vet'}]
 
-	We follow pagination for each query and dedupe by place_id.
+def validate_api_key(api_key: str, session: Optional[requests.Session] = None) -> Optional[str]:
+	"""Issue one lightweight Find Place request to check the key before the full sweep.
+
+	Returns None when the key works, otherwise an error message describing why it was rejected.
 	"""
-	base = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-	results_by_id: Dict[str, Dict[str, Any]] = {}
+	params = {
+		"input": "veterinary",
+		"inputtype": "textquery",
+		"fields": "place_id",
+		"key": api_key,
+	}
+	try:
+		resp = places_get(session or SESSION, FIND_PLACE_URL, params)
+		resp.raise_for_status()
+		data = parse_response(resp)
+	except Exception as e:
+		return f"validation request failed: {e}"
+	status = data.get("status")
+	if status in ("REQUEST_DENIED", "INVALID_REQUEST") or status in QUOTA_STATUSES:
+		return f"{status}: {data.get('error_message', 'API key rejected')}"
+	return None
+
+# Backoff schedule while waiting for a next_page_token to become valid.
+PAGETOKEN_INITIAL_DELAY = 0.3
+PAGETOKEN_MAX_DELAY = 2.0
+PAGETOKEN_MAX_ATTEMPTS = 5
+
+
+def _run_query(lat: float, lng: float, radius: int, api_key: str, q: Dict[str, Optional[str]], session: requests.Session, stop: Optional[threading.Event] = None) -> List[Dict[str, Any]]:
+	"""Run a single Nearby Search query, following pagination (up to 3 pages).
+
+	`stop` is set once any query hits the quota; remaining pages are then skipped.
+	"""
+	params = {
+		"location": f"{lat},{lng}",
+		"radius": radius,
+		"key": api_key,
+	}
+	if q.get("type"):
+		params["type"] = q["type"]
+	if q.get("keyword"):
+		params["keyword"] = q["keyword"]
+
+	items: List[Dict[str, Any]] = []
+	page = 0
+	while True:
+		page += 1
+		if stop is not None and stop.is_set():
+			raise QuotaExceededError("aborted: another query exceeded the quota")
+		if page == 1:
+			resp = places_get(session, NEARBY_SEARCH_URL, params)
+			resp.raise_for_status()
+			data = parse_response(resp)
+		else:
+			data = _fetch_next_page(params, session)
+		try:
+			_check_quota(data)
+		except QuotaExceededError:
+			if stop is not None:
+				stop.set()
+			raise
+		items.extend(data.get("results", []))
+
+		next_token = data.get("next_page_token")
+		if not next_token or page >= 3:
+			break
 
-	for q in queries:
 		params = {
-			"location": f"{lat},{lng}",
-			"radius": radius,
+			"pagetoken": next_token,
 			"key": api_key,
 		}
-		if q.get("type"):
-			params["type"] = q["type"]
-		if q.get("keyword"):
-			params["keyword"] = q["keyword"]
 
-		page = 0
-		while True:
-			page += 1
-			resp = requests.get(base, params=params, timeout=10)
-			resp.raise_for_status()
-			data = resp.json()
-			for item in data.get("results", []):
+	return items
+
+
+def _fetch_next_page(params: Dict[str, Any], session: requests.Session) -> Dict[str, Any]:
+	"""Fetch a pagetoken page, polling with short exponential backoff until the token is valid.
+
+	Per Google docs, next_page_token may take a short time to become valid; until then the
+	API answers INVALID_REQUEST. The token is usually ready well under 2s, so polling beats
+	an unconditional fixed sleep.
+	"""
+	delay = PAGETOKEN_INITIAL_DELAY
+	data: Dict[str, Any] = {}
+	for _ in range(PAGETOKEN_MAX_ATTEMPTS):
+		time.sleep(delay)
+		resp = places_get(session, NEARBY_SEARCH_URL, params)
+		resp.raise_for_status()
+		data = parse_response(resp)
+		if data.get("status") != "INVALID_REQUEST":
+			break
+		delay = min(delay * 2, PAGETOKEN_MAX_DELAY)
+	return data
+
+
+def nearby_search(lat: float, lng: float, radius: int, api_key: str, queries: List[Dict[str, Optional[str]]], session: Optional[requests.Session] = None, max_workers: int = DEFAULT_WORKERS) -> List[Dict[str, Any]]:
+	"""Perform multiple Nearby Search queries (type/keyword combos) and return deduplicated result items.
+
+	`queries` should be a list of dicts with either 'type' or 'keyword' (or both). Example:
+	  [{'type': 'veterinary_care'}, {'keyword': 'veterinary'}, {'keyword': 'vet'}]
+
+	Each query's pagination chain is independent, so queries run concurrently and their
+	pagination sleeps overlap. Results are merged in query order and deduped by place_id.
+	Raises QuotaExceededError as soon as any query reports OVER_QUERY_LIMIT.
+	"""
+	session = session or SESSION
+	results_by_id: Dict[str, Dict[str, Any]] = {}
+	if not queries:
+		return []
+
+	stop = threading.Event()
+	with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as executor:
+		per_query = executor.map(lambda q: _run_query(lat, lng, radius, api_key, q, session, stop), queries)
+		for items in per_query:
+			for item in items:
 				pid = item.get("place_id")
 				if not pid:
 					continue
@@ -99,24 +295,14 @@ def nearby_search(lat: float, lng: float, radius: int, api_key: str, queries: Li
 				if pid not in results_by_id:
 					results_by_id[pid] = item
 
-			next_token = data.get("next_page_token")
-			if not next_token or page >= 3:
-				break
-
-			# Per Google docs, next_page_token may take a short time to become valid.
-			time.sleep(2)
-			params = {
-				"pagetoken": next_token,
-				"key": api_key,
-			}
-
 	return list(results_by_id.values())
 
 
-def place_details(place_id: str, api_key: str) -> Dict[str, Any]:
+def place_details(place_id: str, api_key: str, session: Optional[requests.Session] = None, with_reviews: bool = False) -> Dict[str, Any]:
 	"""Fetch Place Details for a place_id.
 
-	We request a broad set of fields to capture the "place context" for testing.
+	We request the fields used downstream. `photos` is never used and `reviews` (a few KB of
+	text per place) is only requested when `with_reviews` is set, for the sampled star breakdown.
 	"""
 	base = "https://maps.googleapis.com/maps/api/place/details/json"
 	# A comprehensive set of fields that are commonly useful.
@@ -133,45 +319,104 @@ def place_details(place_id: str, api_key: str) -> Dict[str, Any]:
 		"price_level",
 		"opening_hours",
 		"permanently_closed",
-		"photos",
 		"website",
 		"formatted_phone_number",
 		"utc_offset",
-		"reviews",
 	]
+	if with_reviews:
+		fields.append("reviews")
 	params = {
 		"place_id": place_id,
 		"fields": ",".join(fields),
 		"key": api_key,
 	}
-	r = requests.get(base, params=params, timeout=10)
+	r = places_get(session or SESSION, base, params)
 	r.raise_for_status()
-	return r.json()
+	data = parse_response(r)
+	_check_quota(data)
+	return data
+
+
+# Place Details responses are cached by place_id so repeated runs don't re-pay for the same place.
+DETAILS_CACHE_PATH = os.path.join("outputs", ".details_cache")
+DETAILS_CACHE_TTL = 7 * 24 * 3600  # seconds
 
 
-TIER1_TYPES = {
+class DetailsCache:
+	"""Two-level (in-process dict + on-disk shelve) cache of Place Details responses.
+
+	Entries are stored as {"fetched_at": epoch_seconds, "details": response} and expire after `ttl`.
+	Only successful (status OK) responses are cached. Safe to use from the details thread pool.
+	"""
+
+	def __init__(self, path: str = DETAILS_CACHE_PATH, ttl: float = DETAILS_CACHE_TTL):
+		self.ttl = ttl
+		self._mem: Dict[str, Dict[str, Any]] = {}
+		self._lock = threading.Lock()
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		self._shelf = shelve.open(path)
+
+	def get(self, place_id: str) -> Optional[Dict[str, Any]]:
+		with self._lock:
+			entry = self._mem.get(place_id)
+			if entry is None:
+				entry = self._shelf.get(place_id)
+				if entry is not None:
+					self._mem[place_id] = entry
+		if entry is None or time.time() - entry.get("fetched_at", 0) > self.ttl:
+			return None
+		return entry["details"]
+
+	def put(self, place_id: str, details: Dict[str, Any]) -> None:
+		if details.get("status") != "OK":
+			return
+		entry = {"fetched_at": time.time(), "details": details}
+		with self._lock:
+			self._mem[place_id] = entry
+			self._shelf[place_id] = entry
+
+	def close(self) -> None:
+		with self._lock:
+			self._shelf.close()
+
+
+def cached_place_details(place_id: str, api_key: str, cache: Optional[DetailsCache] = None, session: Optional[requests.Session] = None, with_reviews: bool = False) -> Dict[str, Any]:
+	"""place_details() with a read-through DetailsCache (no caching when `cache` is None)."""
+	# Responses with and without reviews carry different fields, so cache them separately
+	key = f"{place_id}|reviews" if with_reviews else place_id
+	if cache is not None:
+		hit = cache.get(key)
+		if hit is not None:
+			return hit
+	details = place_details(place_id, api_key, session, with_reviews)
+	if cache is not None:
+		cache.put(key, details)
+	return details
+
+
+TIER1_TYPES = frozenset({
 	"veterinary_care",
 	"veterinarian",
 	"veterinary_pharmacy",
 	"animal_hospital",
 	"emergency_veterinarian_service",
-}
+})
 
 # Secondary types that are pet-related; require stronger textual evidence to classify as vet
-TIER2_TYPES = {
+TIER2_TYPES = frozenset({
 	"pet_store",
 	"pet_groomer",
 	"pet_care_service",
 	"pet_boarding_service",
 	"pet_trainer",
 	"animal_shelter",
-}
+})
 
 # Wider sweep (optional) — farm and hospital variants
-TIER3_TYPES = {
+TIER3_TYPES = frozenset({
 	"farm",
 	"animal_husbandry",
-}
+})
 
 KEYWORD_STRONG = [
 	"vet",
@@ -188,29 +433,42 @@ KEYWORD_STRONG = [
 ]
 
 
+BOOKING_TOKENS = ["book", "appointment", "schedule", "online-booking", "reserve", "booking", "calendly", "setmore", "patient portal", "portal", "appointments"]
+
+
 def text_has_keyword(text: Optional[str]) -> bool:
+	"""Return True if `text` (already lowercased, see lowered_text) contains any KEYWORD_STRONG entry."""
 	if not text:
 		return False
-	t = text.lower()
-	for kw in KEYWORD_STRONG:
-		if kw in t:
-			return True
-	return False
+	return any(kw in text for kw in KEYWORD_STRONG)
+
 
+def lowered_text(res: Dict[str, Any]) -> Tuple[str, str, str]:
+	"""Return the lowercased (name, formatted_address, website) of a place result.
 
-def classify_place(details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+	Computed once per place and passed to classify_place/score_place so they don't re-lowercase.
+	"""
+	return (
+		(res.get("name") or "").lower(),
+		(res.get("formatted_address") or "").lower(),
+		(res.get("website") or "").lower(),
+	)
+
+
+def classify_place(details: Dict[str, Any], lowered: Optional[Tuple[str, str, str]] = None) -> Optional[Dict[str, Any]]:
 	"""Classify a place details response into Tier 1 (highly likely), Tier 2 (probable), or None.
 
+	`lowered` is the optional precomputed result of lowered_text() for this place.
 	Returns an analysis dict when the place should be kept, or None to discard.
 	"""
 	res = details.get("result", {})
-	types = set(res.get("types", []))
-	name = res.get("name", "")
-	address = res.get("formatted_address", "")
-	website = res.get("website", "")
+	# A place has only a handful of types; membership tests against the frozensets
+	# are cheaper than building a transient set for an intersection.
+	types = res.get("types") or []
+	name, address, website = lowered or lowered_text(res)
 
 	# Tier 1: explicit type match
-	matched_t1 = list(TIER1_TYPES & types)
+	matched_t1 = [t for t in types if t in TIER1_TYPES]
 	if matched_t1:
 		return {
 			"tier": 1,
@@ -220,7 +478,7 @@ def classify_place(details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 		}
 
 	# Tier 2: secondary types but require textual evidence
-	matched_t2 = list(TIER2_TYPES & types)
+	matched_t2 = [t for t in types if t in TIER2_TYPES]
 	if matched_t2:
 		# Strong if name/address/website contains vet-related keywords
 		if text_has_keyword(name) or text_has_keyword(address) or text_has_keyword(website):
@@ -232,7 +490,7 @@ def classify_place(details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 			}
 
 	# Tier 3: optional wider-sweep types — treat similarly to Tier2 but weaker
-	matched_t3 = list(TIER3_TYPES & types)
+	matched_t3 = [t for t in types if t in TIER3_TYPES]
 	if matched_t3:
 		if text_has_keyword(name) or text_has_keyword(address) or text_has_keyword(website):
 			return {
@@ -254,7 +512,7 @@ def classify_place(details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 	return None
 
 
-def score_place(details: Dict[str, Any]) -> Dict[str, Any]:
+def score_place(details: Dict[str, Any], lowered: Optional[Tuple[str, str, str]] = None) -> Dict[str, Any]:
 	"""Compute a heuristic score (0-100) estimating likelihood the place exposes appointment/slot-level BMS.
 
 	Scoring is conservative and local-only. It combines:
@@ -263,13 +521,12 @@ def score_place(details: Dict[str, Any]) -> Dict[str, Any]:
 	  - presence of booking-related words on the website URL or in known booking providers
 	  - small boosts for contact presence and ratings
 
+	`lowered` is the optional precomputed result of lowered_text() for this place.
 	Returns a dict: {score: float, reasons: {name:weight,...}}
 	"""
 	res = details.get("result", {})
-	types = set(res.get("types", []))
-	name = (res.get("name") or "").lower()
-	address = (res.get("formatted_address") or "").lower()
-	website = (res.get("website") or "").lower()
+	types = res.get("types") or []
+	name, address, website = lowered or lowered_text(res)
 	phone = bool(res.get("formatted_phone_number"))
 
 	reasons: Dict[str, float] = {}
@@ -280,7 +537,7 @@ def score_place(details: Dict[str, Any]) -> Dict[str, Any]:
 		reasons["type:veterinary_care"] = 60.0
 		score += 60.0
 	else:
-		inter = TIER2_TYPES & types
+		inter = [t for t in types if t in TIER2_TYPES]
 		if inter:
 			# weaker signal for secondary types
 			reasons[f"type:{','.join(sorted(inter))}"] = 20.0
@@ -303,8 +560,7 @@ def score_place(details: Dict[str, Any]) -> Dict[str, Any]:
 			score += 8.0
 
 	# Booking/appointment signals on website URL itself (cheap heuristic)
-	booking_tokens = ["book", "appointment", "schedule", "online-booking", "reserve", "booking", "calendly", "setmore", "patient portal", "portal", "appointments"]
-	for bt in booking_tokens:
+	for bt in BOOKING_TOKENS:
 		if bt in website:
 			reasons[f"website_book_token:{bt}"] = 15.0
 			score += 15.0
@@ -326,17 +582,198 @@ def score_place(details: Dict[str, Any]) -> Dict[str, Any]:
 	final_score = max(0.0, min(100.0, score))
 	return {"score": round(final_score, 2), "reasons": reasons}
 
+
+# Minimum heuristic score a place needs to be kept (see the inclusion rules in main()).
+MIN_FINAL_SCORE = 20.0
+
+
+# Define CSV columns in a stable order to match the JSON fields.
+CSV_FIELDNAMES = [
+	"business_name",
+	"address",
+	"primary_category",
+	"phone",
+	"zip_code",
+	"city",
+	"state",
+	"state_code",
+	"plus_code",
+	"website",
+	"cid",
+	"latitude",
+	"longitude",
+	"total_reviews",
+	"average_rating",
+	"1_star_reviews",
+	"2_star_reviews",
+	"3_star_reviews",
+	"4_star_reviews",
+	"5_star_reviews",
+	"monday_hours",
+	"tuesday_hours",
+	"wednesday_hours",
+	"thursday_hours",
+	"friday_hours",
+	"saturday_hours",
+	"sunday_hours",
+]
+
+
+def dumps_json(obj: Any) -> bytes:
+	"""Serialize `obj` to compact UTF-8 JSON bytes (orjson when available)."""
+	if orjson is not None:
+		return orjson.dumps(obj)
+	return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def index_components(ac_list: Optional[List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+	"""Map each address component type to its first component in one pass (O(1) lookups afterwards)."""
+	ac_index: Dict[str, Dict[str, Any]] = {}
+	for ac in ac_list or []:
+		for t in ac.get("types", []):
+			ac_index.setdefault(t, ac)
+	return ac_index
+
+
+def extract_component(ac_index: Dict[str, Dict[str, Any]], ac_type: str, short: bool = False) -> str:
+	ac = ac_index.get(ac_type)
+	if ac is None:
+		return ""
+	return ac.get("short_name") if short else ac.get("long_name")
+
+
+def simplify_place(res: Dict[str, Any]) -> Dict[str, Any]:
+	"""Flatten a Place Details `result` into a CSV-friendly row keyed by CSV_FIELDNAMES."""
+	get = res.get  # bound once; called for every field below
+
+	# Basic fields
+	name = get("name", "")
+	address = get("formatted_address", "")
+	types = get("types", []) or []
+	primary_category = types[0] if types else ""
+	phone = get("formatted_phone_number", "")
+
+	# Address components
+	ac = index_components(get("address_components"))
+	zip_code = extract_component(ac, "postal_code")
+	city = extract_component(ac, "locality") or extract_component(ac, "postal_town") or extract_component(ac, "administrative_area_level_2")
+	state = extract_component(ac, "administrative_area_level_1")
+	state_code = extract_component(ac, "administrative_area_level_1", short=True)
+
+	# Plus code
+	plus = get("plus_code") or {}
+	plus_code = plus.get("global_code") or plus.get("compound_code") or ""
+
+	website = get("website", "")
+
+	# CID (try to parse from maps URL if present)
+	cid = ""
+	maps_url = get("url") or get("canonical_url") or ""
+	if maps_url:
+		try:
+			q = parse_qs(urlparse(maps_url).query)
+			cid_vals = q.get("cid")
+			if cid_vals:
+				cid = cid_vals[0]
+		except Exception:
+			cid = ""
+
+	# Location
+	loc = (get("geometry") or {}).get("location") or {}
+	lat_val = loc.get("lat")
+	lng_val = loc.get("lng")
+
+	# Ratings
+	total_reviews = get("user_ratings_total") or 0
+	avg_rating = get("rating") or 0
+
+	# Star breakdown from sampled reviews (may be partial; all zero unless run with --with-reviews)
+	star_counts = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+	for rv in get("reviews", []) or []:
+		rscore = rv.get("rating")
+		try:
+			ir = int(round(float(rscore)))
+		except Exception:
+			continue
+		if ir < 1:
+			ir = 1
+		if ir > 5:
+			ir = 5
+		star_counts[ir] = star_counts.get(ir, 0) + 1
+
+	# Opening hours (weekday_text is usually ['Monday: ...', ...])
+	oh = get("opening_hours") or {}
+	weekday_text = oh.get("weekday_text") or []
+	# Map defaults
+	hours_map = {"Monday": "", "Tuesday": "", "Wednesday": "", "Thursday": "", "Friday": "", "Saturday": "", "Sunday": ""}
+	for line in weekday_text:
+		if not isinstance(line, str):
+			continue
+		if ":" in line:
+			try:
+				day, times = line.split(":", 1)
+				day = day.strip()
+				hours_map[day] = times.strip()
+			except Exception:
+				continue
+
+	return {
+		"business_name": name,
+		"address": address,
+		"primary_category": primary_category,
+		"phone": phone,
+		"zip_code": zip_code,
+		"city": city,
+		"state": state,
+		"state_code": state_code,
+		"plus_code": plus_code,
+		"website": website,
+		"cid": cid,
+		"latitude": lat_val,
+		"longitude": lng_val,
+		"total_reviews": total_reviews,
+		"average_rating": avg_rating,
+		"1_star_reviews": star_counts[1],
+		"2_star_reviews": star_counts[2],
+		"3_star_reviews": star_counts[3],
+		"4_star_reviews": star_counts[4],
+		"5_star_reviews": star_counts[5],
+		"monday_hours": hours_map.get("Monday", ""),
+		"tuesday_hours": hours_map.get("Tuesday", ""),
+		"wednesday_hours": hours_map.get("Wednesday", ""),
+		"thursday_hours": hours_map.get("Thursday", ""),
+		"friday_hours": hours_map.get("Friday", ""),
+		"saturday_hours": hours_map.get("Saturday", ""),
+		"sunday_hours": hours_map.get("Sunday", ""),
+	}
+
+
 def main(argv: Optional[List[str]] = None) -> int:
 	parser = argparse.ArgumentParser(description="Places API test script: Nearby Search + Details")
 	parser.add_argument("--radius", type=int, default=25000, help="search radius in meters (default 25000 = 25 km)")
 	parser.add_argument("--type", default="restaurant", help="place type to search for (default 'restaurant')")
 	parser.add_argument("--lat", type=float, help="latitude (skip IP lookup)")
 	parser.add_argument("--lng", type=float, help="longitude (skip IP lookup)")
+	parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"max concurrent API requests (default {DEFAULT_WORKERS}, capped at the {POOL_MAXSIZE}-connection pool)")
+	parser.add_argument("--qps", type=float, default=DEFAULT_QPS, help=f"max Places API requests per second across all workers (default {DEFAULT_QPS:g})")
+	parser.add_argument("--with-reviews", action="store_true", help="also fetch up to 5 sampled reviews per place to fill the star-breakdown columns")
+	parser.add_argument("--no-cache", action="store_true", help="always fetch fresh Place Details (skip the local details cache)")
 	args = parser.parse_args(argv)
 
+	global RATE_LIMITER
+	if args.qps <= 0:
+		parser.error("--qps must be positive")
+	RATE_LIMITER = TokenBucket(args.qps)
+
 	if API_KEY == "YOUR_API_KEY_HERE":
 		print("WARNING: Using placeholder API key. Set GCP_PLACES_API_KEY environment variable to a valid key.")
 
+	# Fail fast on a bad key instead of issuing dozens of doomed requests
+	key_error = validate_api_key(API_KEY)
+	if key_error:
+		print(f"API key validation failed ({key_error}). Check GCP_PLACES_API_KEY and the key's Places API access.")
+		return 5
+
 	if args.lat is None or args.lng is None:
 		print("Attempting to determine approximate location from public IP...")
 		loc = get_ip_location()
@@ -348,6 +785,16 @@ def main(argv: Optional[List[str]] = None) -> int:
 	else:
 		lat, lng = args.lat, args.lng
 
+	workers = max(1, min(args.workers, POOL_MAXSIZE))
+
+	cache = None
+	if not args.no_cache:
+		try:
+			cache = DetailsCache()
+		except Exception as e:
+			# e.g. the cache file is locked by another run or corrupt; the cache is only an optimization
+			print(f"WARNING: could not open details cache ({e}); continuing without it.")
+
 	try:
 		print(f"Running targeted Nearby Searches for veterinary-related places within radius={args.radius}m")
 
@@ -360,84 +807,113 @@ def main(argv: Optional[List[str]] = None) -> int:
 		queries = type_queries + keyword_queries
 
 		# Single-radius search only (minimize API calls) — default radius is 25km
-		raw_results = nearby_search(lat, lng, args.radius, API_KEY, queries)
+		raw_results = nearby_search(lat, lng, args.radius, API_KEY, queries, max_workers=workers)
 		print(f"Nearby Search returned {len(raw_results)} unique raw results (deduped)")
 
-		detailed_places: List[Dict[str, Any]] = []
-		for idx, item in enumerate(raw_results, start=1):
-			place_id = item.get("place_id")
-			name = item.get("name")
-			print(f"[{idx}/{len(raw_results)}] Fetching details for: {name} ({place_id})")
+		# Prepare output directory and filename with timestamp
+		output_dir = "outputs"
+		os.makedirs(output_dir, exist_ok=True)
+		timestamp = time.strftime("%Y%m%dT%H%M%S")
+
+		# Use a fixed base name so outputs are predictable
+		base_name = "places_full"
+		out_filename = f"{base_name}_{timestamp}.json"
+		out_path = os.path.join(output_dir, out_filename)
+		csv_filename = f"{base_name}_{timestamp}.csv"
+		csv_path = os.path.join(output_dir, csv_filename)
+		# Stream into temporary files; they only replace the previous outputs once the run succeeds
+		out_part = out_path + ".part"
+		csv_part = csv_path + ".part"
+
+		quota_exceeded = threading.Event()
+
+		def fetch_details(item: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+			if quota_exceeded.is_set():
+				raise QuotaExceededError("aborted: Place Details quota exceeded")
 			try:
-				details = place_details(place_id, API_KEY)
+				return item, cached_place_details(item.get("place_id"), API_KEY, cache, with_reviews=args.with_reviews)
+			except QuotaExceededError:
+				# No point continuing the batch; every remaining call would fail the same way
+				quota_exceeded.set()
+				raise
 			except Exception as e:
-				print(f"  ERROR fetching details for {place_id}: {e}")
 				# keep the raw item as fallback
-				details = {"error": str(e), "raw": item}
+				return item, {"error": str(e), "raw": item}
 
-			# Require website presence (we need a website to query for appointment widget etc.)
-			res_quick = details.get("result", {})
-			website = res_quick.get("website")
-			if not website:
-				print(f"  Discarding {place_id}: no website present")
-				continue
+		# Fetch, filter, score and simplify in a single streaming pass: each place is written to
+		# the JSON and CSV outputs as soon as it is processed, so no full-run list is held in memory.
+		# Details calls are independent I/O-bound round-trips, so overlap them on a thread pool;
+		# executor.map yields in submission order, keeping the output order stable.
+		written = 0
+		try:
+			# Use newline='' for correct newline handling on Windows
+			with open(out_part, "wb") as jsonf, open(csv_part, "w", encoding="utf-8", newline='') as csvf, ThreadPoolExecutor(max_workers=workers) as executor:
+				jsonf.write(b'{"search_center":' + dumps_json({"lat": lat, "lng": lng}) + b',"places":[')
+				writer = csv.writer(csvf)
+				writer.writerow(CSV_FIELDNAMES)
+
+				for idx, (item, details) in enumerate(executor.map(fetch_details, raw_results), start=1):
+					place_id = item.get("place_id")
+					name = item.get("name")
+					print(f"[{idx}/{len(raw_results)}] Fetched details for: {name} ({place_id})")
+					if "error" in details:
+						print(f"  ERROR fetching details for {place_id}: {details['error']}")
+
+					# Require website presence (we need a website to query for appointment widget etc.)
+					res = details.get("result", {})
+					website = res.get("website")
+					if not website:
+						print(f"  Discarding {place_id}: no website present")
+						continue
 
-			# Compute a heuristic AI-style score (local rules) to rank BMS likelihood
-			score_info = score_place(details)
-			heuristic_score = score_info.get("score", 0.0)
+					# Lowercase name/address/website once and share it between scoring and classification
+					lowered = lowered_text(res)
 
-			# Decision rules for inclusion using the heuristic score:
-			# - If heuristic > 30: include immediately (strong signal)
-			# - If heuristic < 10: discard immediately (too weak)
-			# - If heuristic in [10,30]: treat as borderline and use the heuristic value
-			final_score = heuristic_score
+					# Compute a heuristic AI-style score (local rules) to rank BMS likelihood
+					score_info = score_place(details, lowered)
+					heuristic_score = score_info.get("score", 0.0)
 
-			if heuristic_score > 30.0:
-				print(f"  Heuristic strong: {place_id} score={heuristic_score} (>30) -> include")
-			elif heuristic_score < 10.0:
-				print(f"  Heuristic weak: {place_id} score={heuristic_score} (<10) -> discard")
-				continue
-			else:
-				# borderline case: 10-30 -> use heuristic
-				print(f"  Borderline {place_id} (heuristic={heuristic_score}) -> using heuristic")
-				final_score = heuristic_score
-
-			# Require final score > 20 to include
-			if final_score <= 20.0:
-				print(f"  Discarding {place_id}: final_score={final_score} <= 20.0")
-				continue
+					# Decision rules for inclusion using the heuristic score:
+					# - If heuristic > 30: include immediately (strong signal)
+					# - If heuristic < 10: discard immediately (too weak)
+					# - If heuristic in [10,30]: treat as borderline and use the heuristic value
+					final_score = heuristic_score
 
-			# Optionally also derive a tiered label from classify_place (keeps previous behavior)
-			tier_info = classify_place(details) or {}
-
-			# Attach analysis and scoring to the top-level details object
-			details_out = dict(details)  # shallow copy
-			details_out["analysis"] = tier_info
-			details_out["heuristic_score"] = heuristic_score
-			details_out["final_score"] = final_score
-			# Script stores heuristic analysis only
-			details_out["score_reasons"] = score_info.get("reasons", {})
-
-			# Provide a concise candidate summary for downstream heuristics
-			res = details_out.get("result", {})
-			candidate_summary = {
-				"place_id": res.get("place_id"),
-				"name": res.get("name"),
-				"formatted_address": res.get("formatted_address"),
-				"types": res.get("types", []),
-				"website": res.get("website"),
-				"formatted_phone_number": res.get("formatted_phone_number"),
-				"rating": res.get("rating"),
-				"user_ratings_total": res.get("user_ratings_total"),
-			}
-			details_out["candidate_summary"] = candidate_summary
-
-			detailed_places.append(details_out)
+					if heuristic_score > 30.0:
+						print(f"  Heuristic strong: {place_id} score={heuristic_score} (>30) -> include")
+					elif heuristic_score < 10.0:
+						print(f"  Heuristic weak: {place_id} score={heuristic_score} (<10) -> discard")
+						continue
+					else:
+						# borderline case: 10-30 -> use heuristic
+						print(f"  Borderline {place_id} (heuristic={heuristic_score}) -> using heuristic")
+						final_score = heuristic_score
+
+					# Require final score > MIN_FINAL_SCORE (20) to include
+					if final_score <= MIN_FINAL_SCORE:
+						print(f"  Discarding {place_id}: final_score={final_score} <= {MIN_FINAL_SCORE}")
+						continue
 
-		# Prepare output directory and filename with timestamp
-		output_dir = "outputs"
-		os.makedirs(output_dir, exist_ok=True)
-		timestamp = time.strftime("%Y%m%dT%H%M%S")
+					# Also derive a tiered label from classify_place for the run log
+					tier_info = classify_place(details, lowered) or {}
+					print(f"  Keeping {place_id}: final_score={final_score} tier={tier_info.get('tier')} ({tier_info.get('label', 'unclassified')})")
+
+					row = simplify_place(res)
+					if written:
+						jsonf.write(b",")
+					jsonf.write(dumps_json(row))
+					# Emit values positionally in column order; missing/None -> '' for CSV cleanliness
+					values = [row.get(k) for k in CSV_FIELDNAMES]
+					writer.writerow(["" if v is None else v for v in values])
+					written += 1
+
+				jsonf.write(b"]}")
+		except BaseException:
+			# Aborted (quota, HTTP error, Ctrl-C...): drop the partial files and keep previous outputs in place
+			for part in (out_part, csv_part):
+				if os.path.exists(part):
+					os.remove(part)
+			raise
 
 		# Archive any existing top-level outputs matching the pattern
 		archives_base = os.path.join(output_dir, "archives")
@@ -447,214 +923,38 @@ def main(argv: Optional[List[str]] = None) -> int:
 		os.makedirs(csvs_dir, exist_ok=True)
 
 		# Only match files directly under outputs/ with the expected naming pattern
-		pattern = re.compile(r"^places_full_\d{8}T\d{6}\.(json|csv)$")
-		for fname in os.listdir(output_dir):
-			# Skip archives directory and subdirectories
-			fpath = os.path.join(output_dir, fname)
-			if not os.path.isfile(fpath):
-				continue
-			if not pattern.match(fname):
-				continue
-			lower = fname.lower()
-			if lower.endswith('.json'):
-				dest_dir = jsons_dir
-			elif lower.endswith('.csv'):
-				dest_dir = csvs_dir
-			else:
-				dest_dir = archives_base
-
-			dest = os.path.join(dest_dir, fname)
-			try:
-				shutil.move(fpath, dest)
-				print(f"Archived existing output {fpath} -> {dest}")
-			except Exception as e:
-				print(f"Failed to archive {fpath}: {e}")
-
-		# Use a fixed base name so outputs are predictable
-		base_name = "places_full"
-		out_filename = f"{base_name}_{timestamp}.json"
-		out_path = os.path.join(output_dir, out_filename)
-
-		# Build a simplified, flat JSON that's CSV-friendly and contains the most useful fields per place
-		from urllib.parse import urlparse, parse_qs
-
-		def extract_component(ac_list, ac_type, short=False):
-			if not ac_list:
-				return ""
-			for ac in ac_list:
-				types = ac.get("types", [])
-				if ac_type in types:
-					return ac.get("short_name") if short else ac.get("long_name")
-			return ""
-
-		simplified: List[Dict[str, Any]] = []
-		for d in detailed_places:
-			res = d.get("result") or {}
-			# Basic fields
-			name = res.get("name", "")
-			address = res.get("formatted_address", "")
-			types = res.get("types", []) or []
-			primary_category = types[0] if types else ""
-			phone = res.get("formatted_phone_number", "")
-
-			# Address components
-			ac = res.get("address_components", []) or []
-			zip_code = extract_component(ac, "postal_code")
-			city = extract_component(ac, "locality") or extract_component(ac, "postal_town") or extract_component(ac, "administrative_area_level_2")
-			state = extract_component(ac, "administrative_area_level_1")
-			state_code = extract_component(ac, "administrative_area_level_1", short=True)
-
-			# Plus code
-			plus = res.get("plus_code") or {}
-			plus_code = plus.get("global_code") or plus.get("compound_code") or ""
-
-			website = res.get("website", "")
-
-			# CID (try to parse from maps URL if present)
-			cid = ""
-			maps_url = res.get("url") or res.get("canonical_url") or ""
-			if maps_url:
-				try:
-					q = parse_qs(urlparse(maps_url).query)
-					cid_vals = q.get("cid")
-					if cid_vals:
-						cid = cid_vals[0]
-				except Exception:
-					cid = ""
-
-			# Location
-			lat_val = None
-			lng_val = None
-			geom = res.get("geometry") or {}
-			loc = geom.get("location") if geom else None
-			if loc:
-				lat_val = loc.get("lat")
-				lng_val = loc.get("lng")
-
-			# Ratings
-			total_reviews = res.get("user_ratings_total") or 0
-			avg_rating = res.get("rating") or 0
-
-			# Star breakdown from sampled reviews (may be partial)
-			star_counts = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-			for rv in res.get("reviews", []) or []:
-				rscore = rv.get("rating")
-				try:
-					ir = int(round(float(rscore)))
-				except Exception:
+		# (glob doesn't recurse without '**', so the archives subdirectories are never matched)
+		stamp_glob = "[0-9]" * 8 + "T" + "[0-9]" * 6
+		for ext, dest_dir in ((".json", jsons_dir), (".csv", csvs_dir)):
+			for fpath in glob.glob(os.path.join(output_dir, f"places_full_{stamp_glob}{ext}")):
+				if not os.path.isfile(fpath):
 					continue
-				if ir < 1:
-					ir = 1
-				if ir > 5:
-					ir = 5
-				star_counts[ir] = star_counts.get(ir, 0) + 1
-
-			# Opening hours (weekday_text is usually ['Monday: ...', ...])
-			oh = res.get("opening_hours") or {}
-			weekday_text = oh.get("weekday_text") or []
-			# Map defaults
-			hours_map = {"Monday": "", "Tuesday": "", "Wednesday": "", "Thursday": "", "Friday": "", "Saturday": "", "Sunday": ""}
-			for line in weekday_text:
-				if not isinstance(line, str):
-					continue
-				if ":" in line:
-					try:
-						day, times = line.split(":", 1)
-						day = day.strip()
-						hours_map[day] = times.strip()
-					except Exception:
-						continue
-
-			simplified.append({
-				"business_name": name,
-				"address": address,
-				"primary_category": primary_category,
-				"phone": phone,
-				"zip_code": zip_code,
-				"city": city,
-				"state": state,
-				"state_code": state_code,
-				"plus_code": plus_code,
-				"website": website,
-				"cid": cid,
-				"latitude": lat_val,
-				"longitude": lng_val,
-				"total_reviews": total_reviews,
-				"average_rating": avg_rating,
-				"1_star_reviews": star_counts[1],
-				"2_star_reviews": star_counts[2],
-				"3_star_reviews": star_counts[3],
-				"4_star_reviews": star_counts[4],
-				"5_star_reviews": star_counts[5],
-				"monday_hours": hours_map.get("Monday", ""),
-				"tuesday_hours": hours_map.get("Tuesday", ""),
-				"wednesday_hours": hours_map.get("Wednesday", ""),
-				"thursday_hours": hours_map.get("Thursday", ""),
-				"friday_hours": hours_map.get("Friday", ""),
-				"saturday_hours": hours_map.get("Saturday", ""),
-				"sunday_hours": hours_map.get("Sunday", ""),
-			})
-
-		# Write simplified JSON (pretty-printed for readability)
-		with open(out_path, "w", encoding="utf-8") as f:
-			json.dump({"search_center": {"lat": lat, "lng": lng}, "places": simplified}, f, ensure_ascii=False, indent=2)
-
-		# Also write a CSV alongside the JSON for easy analysis / spreadsheet import.
-		csv_filename = f"{base_name}_{timestamp}.csv"
-		csv_path = os.path.join(output_dir, csv_filename)
-
-		# Define CSV columns in a stable order to match the JSON fields.
-		fieldnames = [
-			"business_name",
-			"address",
-			"primary_category",
-			"phone",
-			"zip_code",
-			"city",
-			"state",
-			"state_code",
-			"plus_code",
-			"website",
-			"cid",
-			"latitude",
-			"longitude",
-			"total_reviews",
-			"average_rating",
-			"1_star_reviews",
-			"2_star_reviews",
-			"3_star_reviews",
-			"4_star_reviews",
-			"5_star_reviews",
-			"monday_hours",
-			"tuesday_hours",
-			"wednesday_hours",
-			"thursday_hours",
-			"friday_hours",
-			"saturday_hours",
-			"sunday_hours",
-		]
+				dest = os.path.join(dest_dir, os.path.basename(fpath))
+				try:
+					shutil.move(fpath, dest)
+					print(f"Archived existing output {fpath} -> {dest}")
+				except Exception as e:
+					print(f"Failed to archive {fpath}: {e}")
 
-		try:
-			# Use newline='' for correct newline handling on Windows
-			with open(csv_path, "w", encoding="utf-8", newline='') as csvf:
-				writer = csv.DictWriter(csvf, fieldnames=fieldnames)
-				writer.writeheader()
-				for row in simplified:
-					# Ensure all keys exist and None -> '' for CSV cleanliness
-					out_row = {k: ("" if row.get(k) is None else row.get(k)) for k in fieldnames}
-					writer.writerow(out_row)
-			print(f"Wrote JSON to {out_path} and CSV to {csv_path}")
-		except Exception as e:
-			print(f"Wrote JSON to {out_path} but failed to write CSV: {e}")
+		# Run completed: move the new outputs into place
+		os.replace(out_part, out_path)
+		os.replace(csv_part, csv_path)
+		print(f"Wrote {written} places to JSON {out_path} and CSV {csv_path}")
 
 		return 0
 
+	except QuotaExceededError as e:
+		print("Places API quota exceeded, stopping early (previous outputs left in place):", e)
+		return 6
 	except requests.HTTPError as e:
 		print("HTTP error during API call:", e)
 		return 3
 	except Exception as e:
 		print("Unexpected error:", e)
 		return 4
+	finally:
+		if cache is not None:
+			cache.close()
 
 
 if __name__ == "__main__":